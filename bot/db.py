@@ -1,35 +1,48 @@
 from __future__ import annotations
 
-from datetime import datetime, timezone
+import re
 
-from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
 
 from .models import Base
 
+# postgres:// or postgresql:// without a driver; "postgresql+asyncpg://" does not match
+_PG_PREFIX = re.compile(r"^postgres(?:ql)?://")
+
 
 def to_async_database_url(url: str) -> str:
     """Convert sync postgres URL to asyncpg URL."""
-    if url.startswith("postgresql+asyncpg://"):
-        return url
-    if url.startswith("postgresql://"):
-        return url.replace("postgresql://", "postgresql+asyncpg://", 1)
-    if url.startswith("postgres://"):
-        return url.replace("postgres://", "postgresql+asyncpg://", 1)
-    return url
-
-
-def utcnow() -> datetime:
-    return datetime.now(timezone.utc)
+    return _PG_PREFIX.sub("postgresql+asyncpg://", url, count=1)
 
 
-def create_engine_and_sessionmaker(database_url: str) -> tuple[AsyncEngine, sessionmaker]:
+def create_engine_and_sessionmaker(database_url: str) -> tuple[AsyncEngine, async_sessionmaker[AsyncSession]]:
     async_url = to_async_database_url(database_url)
-    engine = create_async_engine(async_url, pool_pre_ping=True)
-    session_factory = sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
+    if async_url.startswith("sqlite"):
+        # dev/test: no pooling to manage
+        engine = create_async_engine(async_url, poolclass=NullPool)
+    else:
+        engine = create_async_engine(
+            async_url,
+            pool_pre_ping=True,
+            pool_size=20,
+            max_overflow=40,
+            pool_timeout=30,
+            pool_recycle=1800,
+        )
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
     return engine, session_factory
 
 
+def _create_missing_indexes(conn: Connection) -> None:
+    # create_all skips tables that already exist, so indexes added later are created here
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+
 async def init_db(engine: AsyncEngine) -> None:
     async with engine.begin() as conn:
         await conn.run_sync(Base.metadata.create_all)
+        await conn.run_sync(_create_missing_indexes)
@@ -1,16 +1,23 @@
 from __future__ import annotations
 
+from functools import lru_cache
+
 from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup
 
 CURRENCIES = ["USD", "EUR", "UAH", "RUB", "USDT"]
+CURRENCIES_SET = frozenset(CURRENCIES)  # membership checks; the list keeps keyboard order
+
+# Keyboards are static per arguments; build each one once and share the instance.
 
 
+@lru_cache(maxsize=None)
 def kbd_start() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Начать расчёт", callback_data="start_calc")],
     ])
 
 
+@lru_cache(maxsize=None)
 def kbd_choose_currency(prefix: str, exclude: str | None = None) -> InlineKeyboardMarkup:
     rows: list[list[InlineKeyboardButton]] = []
     row: list[InlineKeyboardButton] = []
@@ -27,6 +34,7 @@ def kbd_choose_currency(prefix: str, exclude: str | None = None) -> InlineKeyboa
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@lru_cache(maxsize=None)
 def kbd_amount_mode() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -39,6 +47,7 @@ def kbd_amount_mode() -> InlineKeyboardMarkup:
     ])
 
 
+@lru_cache(maxsize=None)
 def kbd_show_rate() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Показать курс", callback_data="show_rate")],
@@ -46,6 +55,7 @@ def kbd_show_rate() -> InlineKeyboardMarkup:
     ])
 
 
+@lru_cache(maxsize=None)
 def kbd_submit() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="Отправить заявку", callback_data="submit")],
@@ -3,30 +3,89 @@ from __future__ import annotations
 import asyncio
 import logging
 from datetime import datetime, timezone
+from functools import lru_cache
+from typing import AsyncGenerator, AsyncIterator
 
 from aiogram import Bot, Dispatcher, F, Router
 from aiogram.enums import ParseMode
 from aiogram.filters import Command, CommandStart
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import CallbackQuery, Message, BufferedInputFile
+from aiogram.types import CallbackQuery, InputFile, Message
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from .config import Config, load_config
 from .db import create_engine_and_sessionmaker, init_db
-from .keyboards import CURRENCIES, kbd_amount_mode, kbd_choose_currency, kbd_show_rate, kbd_start, kbd_submit
+from .keyboards import CURRENCIES_SET, kbd_amount_mode, kbd_choose_currency, kbd_show_rate, kbd_start, kbd_submit
+from .middlewares import DbSessionMiddleware
 from .rates.service import RateService
-from .repository import create_order, export_users_csv, set_order_calc, set_order_contact_and_submit, upsert_user
+from .repository import (
+    create_order,
+    export_users_csv,
+    run_last_seen_flusher,
+    set_order_calc,
+    set_order_contact_and_submit,
+    upsert_user,
+)
 from .states import ExchangeFlow
 
 router = Router()
 
+# Admin notifications (PLAIN TEXT, no Markdown)
+_MODE_TEXT = {"give": "отдаю", "get": "получу"}
+
+_ADMIN_CALC_TMPL = (
+    "🧮 Расчёт\n"
+    "👤 Пользователь: {ulabel}\n"
+    "🆔 Заказ: #{order_id}\n"
+    "💱 Пара: {give} → {get}\n"
+    "📌 Ввод: {mode_text} {amount}\n"
+    "📍 Откуда: {from_loc}\n"
+    "📍 Куда: {to_loc}\n"
+    "📈 Курс: 1 {give} = {rate:.3f} {get}\n"
+    "➡️ Отдам/получу: {give_out} {give} → {get_out} {get}\n"
+    "🔎 Источники: {sources}\n"
+    "⏱ AsOf (UTC): {as_of:%Y-%m-%d %H:%M}"
+)
+
+_ADMIN_SUBMIT_TMPL = (
+    "🧾 Заявка\n"
+    "👤 Пользователь: {ulabel}\n"
+    "🆔 Заказ: #{order_id}\n"
+    "💱 Пара: {give} → {get}\n"
+    "📌 Ввод: {mode_text} {amount}\n"
+    "📍 Откуда: {from_loc}\n"
+    "📍 Куда: {to_loc}\n"
+    "📈 Курс: 1 {give} = {rate:.3f} {get}\n"
+    "➡️ Отдам/получу: {give_out} {give} → {get_out} {get}\n"
+    "📞 Контакт: {contact}\n"
+    "🔎 Источники: {sources}"
+)
+
 
 def _user_label(msg_user) -> str:
-    if msg_user.username:
-        return f"@{msg_user.username}"
-    name = (msg_user.first_name or "") + (" " + msg_user.last_name if msg_user.last_name else "")
+    return _format_user_label(msg_user.id, msg_user.username, msg_user.first_name, msg_user.last_name)
+
+
+@lru_cache(maxsize=4096)
+def _format_user_label(user_id: int, username: str | None, first_name: str | None, last_name: str | None) -> str:
+    if username:
+        return f"@{username}"
+    name = (first_name or "") + (" " + last_name if last_name else "")
     name = name.strip() or "(без username)"
-    return f"{name} (id:{msg_user.id})"
+    return f"{name} (id:{user_id})"
+
+
+class _AsyncIterInputFile(InputFile):
+    """Upload from an async iterator of byte chunks (used for streamed exports)."""
+
+    def __init__(self, chunks: AsyncIterator[bytes], filename: str):
+        super().__init__(filename=filename)
+        self.chunks = chunks
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        async for chunk in self.chunks:
+            yield chunk
 
 
 def _parse_amount(text: str) -> float | None:
@@ -54,10 +113,11 @@ def _sources_to_text(path) -> str:
 
 
 @router.message(CommandStart())
-async def cmd_start(message: Message, state: FSMContext, db_session_factory) -> None:
+async def cmd_start(message: Message, state: FSMContext, db: AsyncSession) -> None:
     await state.clear()
-    async with db_session_factory() as db:
-        await upsert_user(db, message.from_user)
+    await upsert_user(db, message.from_user)
+    # registered even if the reply below fails; don't hold the row lock over the Telegram call
+    await db.commit()
     await message.answer(
         "Привет! Я бот обменника.\n\nНажми *Начать расчёт*, чтобы посчитать курс и отправить заявку.",
         reply_markup=kbd_start(),
@@ -68,7 +128,6 @@ async def cmd_start(message: Message, state: FSMContext, db_session_factory) ->
 @router.callback_query(F.data == "start_calc")
 async def start_calc(call: CallbackQuery, state: FSMContext) -> None:
     await state.set_state(ExchangeFlow.choose_give)
-    await state.update_data()
     await call.message.edit_text(
         "Выберите валюту *Отдаёте*:",
         reply_markup=kbd_choose_currency("give"),
@@ -80,7 +139,7 @@ async def start_calc(call: CallbackQuery, state: FSMContext) -> None:
 @router.callback_query(F.data.startswith("give:"))
 async def choose_give(call: CallbackQuery, state: FSMContext) -> None:
     give = call.data.split(":", 1)[1]
-    if give not in CURRENCIES:
+    if give not in CURRENCIES_SET:
         await call.answer("Неизвестная валюта", show_alert=True)
         return
     await state.update_data(give_currency=give)
@@ -96,7 +155,7 @@ async def choose_give(call: CallbackQuery, state: FSMContext) -> None:
 @router.callback_query(F.data.startswith("get:"))
 async def choose_get(call: CallbackQuery, state: FSMContext) -> None:
     get = call.data.split(":", 1)[1]
-    if get not in CURRENCIES:
+    if get not in CURRENCIES_SET:
         await call.answer("Неизвестная валюта", show_alert=True)
         return
     data = await state.get_data()
@@ -157,10 +216,10 @@ async def enter_to_location(message: Message, state: FSMContext) -> None:
     if len(text) < 2:
         await message.answer("Введите, пожалуйста, страна/город получения текстом.")
         return
-    await state.update_data(to_location=text)
+    # update_data returns the merged data, no separate get_data needed
+    data = await state.update_data(to_location=text)
     await state.set_state(ExchangeFlow.waiting_for_calc)
 
-    data = await state.get_data()
     give = data.get("give_currency")
     get = data.get("get_currency")
     mode = data.get("amount_mode")
@@ -184,7 +243,7 @@ async def show_rate(
     call: CallbackQuery,
     state: FSMContext,
     config: Config,
-    db_session_factory,
+    db: AsyncSession,
     rate_service: RateService,
 ) -> None:
 
@@ -217,43 +276,45 @@ async def show_rate(
     get_out = _round_money_no_cents(get_amt)
 
     # Create order record (stage calc)
-    async with db_session_factory() as db:
-        order = await create_order(
-            db,
-            user_id=call.from_user.id,
-            give_currency=give,
-            get_currency=get,
-            amount_mode=mode,
-            amount_value=amount,
-            from_location=from_loc,
-            to_location=to_loc,
-        )
-        await set_order_calc(
-            db,
-            order_id=order.id,
-            rate=rate,
-            calculated_give=float(give_out),
-            calculated_get=float(get_out),
-            sources=sources_text,
-        )
-
-    await state.update_data(order_id=order.id, rate=rate, give_out=give_out, get_out=get_out, sources=sources_text)
+    order_id = await create_order(
+        db,
+        user_id=call.from_user.id,
+        give_currency=give,
+        get_currency=get,
+        amount_mode=mode,
+        amount_value=amount,
+        from_location=from_loc,
+        to_location=to_loc,
+    )
+    await set_order_calc(
+        db,
+        order_id=order_id,
+        rate=rate,
+        calculated_give=float(give_out),
+        calculated_get=float(get_out),
+        sources=sources_text,
+    )
+    # the order id goes to the admin and the user below, so it must be durable first
+    await db.commit()
+
+    await state.update_data(order_id=order_id, rate=rate, give_out=give_out, get_out=get_out, sources=sources_text)
 
     # Notify admin about calculation (PLAIN TEXT, no Markdown)
-    ulabel = _user_label(call.from_user)
-    admin_text = (
-        "🧮 Расчёт\n"
-        f"👤 Пользователь: {ulabel}\n"
-        f"🆔 Заказ: #{order.id}\n"
-        f"💱 Пара: {give} → {get}\n"
-        f"📌 Ввод: {'отдаю' if mode == 'give' else 'получу'} {amount}\n"
-        f"📍 Откуда: {from_loc}\n"
-        f"📍 Куда: {to_loc}\n"
-        f"📈 Курс: 1 {give} = {rate:.3f} {get}\n"
-        f"➡️ Отдам/получу: {give_out} {give} → {get_out} {get}\n"
-        f"🔎 Источники: {sources_text or '—'}\n"
-        f"⏱ AsOf (UTC): {rr.as_of.strftime('%Y-%m-%d %H:%M')}"
-    )
+    admin_text = _ADMIN_CALC_TMPL.format_map({
+        "ulabel": _user_label(call.from_user),
+        "order_id": order_id,
+        "give": give,
+        "get": get,
+        "mode_text": _MODE_TEXT.get(mode, "получу"),
+        "amount": amount,
+        "from_loc": from_loc,
+        "to_loc": to_loc,
+        "rate": rate,
+        "give_out": give_out,
+        "get_out": get_out,
+        "sources": sources_text or "—",
+        "as_of": rr.as_of,
+    })
 
     try:
         await call.bot.send_message(config.admin_id, admin_text)  # <-- без parse_mode
@@ -283,7 +344,7 @@ async def enter_contact(message: Message, state: FSMContext) -> None:
 
 
 @router.callback_query(ExchangeFlow.waiting_for_submit, F.data == "submit")
-async def submit(call: CallbackQuery, state: FSMContext, config: Config, db_session_factory) -> None:
+async def submit(call: CallbackQuery, state: FSMContext, config: Config, db: AsyncSession) -> None:
 
     data = await state.get_data()
     order_id = int(data["order_id"])
@@ -300,24 +361,26 @@ async def submit(call: CallbackQuery, state: FSMContext, config: Config, db_sess
     get_out = int(data["get_out"])
     sources_text = data.get("sources", "")
 
-    async with db_session_factory() as db:
-        await set_order_contact_and_submit(db, order_id=order_id, contact=contact)
+    if not await set_order_contact_and_submit(db, order_id=order_id, contact=contact):
+        logging.warning("Submit for unknown order #%s", order_id)
+    await db.commit()
 
     # Notify admin about submit (PLAIN TEXT, no Markdown)
-    ulabel = _user_label(call.from_user)
-    admin_text = (
-        "🧾 Заявка\n"
-        f"👤 Пользователь: {ulabel}\n"
-        f"🆔 Заказ: #{order_id}\n"
-        f"💱 Пара: {give} → {get}\n"
-        f"📌 Ввод: {'отдаю' if mode == 'give' else 'получу'} {amount}\n"
-        f"📍 Откуда: {from_loc}\n"
-        f"📍 Куда: {to_loc}\n"
-        f"📈 Курс: 1 {give} = {rate:.3f} {get}\n"
-        f"➡️ Отдам/получу: {give_out} {give} → {get_out} {get}\n"
-        f"📞 Контакт: {contact}\n"
-        f"🔎 Источники: {sources_text or '—'}"
-    )
+    admin_text = _ADMIN_SUBMIT_TMPL.format_map({
+        "ulabel": _user_label(call.from_user),
+        "order_id": order_id,
+        "give": give,
+        "get": get,
+        "mode_text": _MODE_TEXT.get(mode, "получу"),
+        "amount": amount,
+        "from_loc": from_loc,
+        "to_loc": to_loc,
+        "rate": rate,
+        "give_out": give_out,
+        "get_out": get_out,
+        "contact": contact,
+        "sources": sources_text or "—",
+    })
 
     try:
         await call.bot.send_message(config.admin_id, admin_text)  # <-- без parse_mode
@@ -330,13 +393,10 @@ async def submit(call: CallbackQuery, state: FSMContext, config: Config, db_sess
 
 
 @router.message(Command("export_users"))
-async def cmd_export_users(message: Message, config: Config, db_session_factory) -> None:
+async def cmd_export_users(message: Message, config: Config, db: AsyncSession) -> None:
     if message.from_user.id != config.admin_id:
         return
-    async with db_session_factory() as db:
-        content = await export_users_csv(db)
-
-    file = BufferedInputFile(content, filename="users.csv")
+    file = _AsyncIterInputFile(export_users_csv(db), filename="users.csv")
     await message.answer_document(file, caption="Выгрузка подписчиков (users.csv)")
 
 
@@ -358,16 +418,30 @@ async def main() -> None:
     bot = Bot(token=cfg.bot_token)
 
     dp = Dispatcher(storage=MemoryStorage())
+    dp.update.middleware(DbSessionMiddleware(session_factory))
     dp.include_router(router)
 
     # store shared dependencies
     dp["config"] = cfg
-    dp["db_session_factory"] = session_factory
-    dp["rate_service"] = RateService(ttl_seconds=cfg.rate_cache_ttl_seconds)
+    rate_service = RateService(ttl_seconds=cfg.rate_cache_ttl_seconds, session_factory=session_factory)
+    await rate_service.load_persisted()
+    dp["rate_service"] = rate_service
 
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    last_seen_flusher = asyncio.create_task(run_last_seen_flusher(session_factory))
+
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        last_seen_flusher.cancel()
+        await asyncio.gather(last_seen_flusher, return_exceptions=True)
+        await rate_service.aclose()
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:  # not available on Windows
+        asyncio.run(main())
+    else:
+        uvloop.run(main())
@@ -0,0 +1,28 @@
+from __future__ import annotations
+
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+
+class DbSessionMiddleware(BaseMiddleware):
+    """One DB session per Telegram update, exposed to handlers as `db` and committed after the handler."""
+
+    def __init__(self, session_factory: async_sessionmaker[AsyncSession]):
+        self.session_factory = session_factory
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        # the connection is checked out lazily, so updates that never touch the DB cost nothing;
+        # an exception skips the commit and the session rolls back on close
+        async with self.session_factory() as session:
+            data["db"] = session
+            result = await handler(event, data)
+            await session.commit()
+            return result
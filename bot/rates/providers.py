@@ -1,13 +1,38 @@
 from __future__ import annotations
 
-import json
+import asyncio
+import io
 from dataclasses import dataclass
 from datetime import datetime, timezone
-from typing import Any
+from typing import Any, Awaitable, Callable, TypeVar
 
 import aiohttp
+import orjson
 from lxml import etree
 
+T = TypeVar("T")
+
+# connect/read limits keep one slow provider from stalling the whole refresh
+_TIMEOUT = aiohttp.ClientTimeout(total=15, connect=3, sock_read=5)
+
+
+async def _with_retry(coro_factory: Callable[[], Awaitable[T]], attempts: int = 2) -> T:
+    for _ in range(attempts - 1):
+        try:
+            return await coro_factory()
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            await asyncio.sleep(0.2)
+    return await coro_factory()
+
+
+async def _get_bytes(session: aiohttp.ClientSession, url: str, params: dict[str, str] | None = None) -> bytes:
+    async def once() -> bytes:
+        async with session.get(url, params=params, timeout=_TIMEOUT) as resp:
+            resp.raise_for_status()
+            return await resp.read()
+
+    return await _with_retry(once)
+
 
 @dataclass(frozen=True)
 class CbrRates:
@@ -36,26 +61,38 @@ async def fetch_cbr(session: aiohttp.ClientSession) -> CbrRates:
     Endpoint: https://www.cbr.ru/scripts/XML_daily.asp
     """
     url = "https://www.cbr.ru/scripts/XML_daily.asp"
-    async with session.get(url, timeout=20) as resp:
-        resp.raise_for_status()
-        raw = await resp.read()
-
-    # XML is usually windows-1251
-    parser = etree.XMLParser(recover=True, encoding="windows-1251")
-    root = etree.fromstring(raw, parser=parser)
-
-    def get_rate(char_code: str) -> float:
-        for valute in root.findall("Valute"):
-            cc = (valute.findtext("CharCode") or "").strip()
-            if cc == char_code:
-                nominal = float((valute.findtext("Nominal") or "1").strip())
-                value_txt = (valute.findtext("Value") or "").strip().replace(",", ".")
-                value = float(value_txt)
-                return value / nominal
-        raise RuntimeError(f"CBR: currency not found: {char_code}")
-
-    eur_rub = get_rate("EUR")
-    usd_rub = get_rate("USD")
+    raw = await _get_bytes(session, url)
+
+    # XML is usually windows-1251; stream <Valute> elements and stop once both codes are found
+    wanted = {"EUR", "USD"}
+    rates: dict[str, float] = {}
+    # no DTD loading, entity expansion or network access: faster and safe against hostile payloads
+    events = etree.iterparse(
+        io.BytesIO(raw),
+        tag="Valute",
+        recover=True,
+        encoding="windows-1251",
+        no_network=True,
+        resolve_entities=False,
+        load_dtd=False,
+        huge_tree=False,
+    )
+    for _, valute in events:
+        cc = (valute.findtext("CharCode") or "").strip()
+        if cc in wanted:
+            nominal = float((valute.findtext("Nominal") or "1").strip())
+            value_txt = (valute.findtext("Value") or "").strip().replace(",", ".")
+            rates[cc] = float(value_txt) / nominal
+        valute.clear()
+        if len(rates) == len(wanted):
+            break
+
+    for char_code in ("EUR", "USD"):
+        if char_code not in rates:
+            raise RuntimeError(f"CBR: currency not found: {char_code}")
+
+    eur_rub = rates["EUR"]
+    usd_rub = rates["USD"]
     return CbrRates(eur_rub=eur_rub, usd_rub=usd_rub, as_of=datetime.now(timezone.utc))
 
 
@@ -64,18 +101,14 @@ async def fetch_nbu(session: aiohttp.ClientSession) -> NbuRates:
     Endpoint: https://bank.gov.ua/NBUStatService/v1/statdirectory/exchange?json
     """
     url = "https://bank.gov.ua/NBUStatService/v1/statdirectory/exchange?json"
-    async with session.get(url, timeout=20) as resp:
-        resp.raise_for_status()
-        data = await resp.json(content_type=None)
-
-    def find(code: str) -> float:
-        for item in data:
-            if (item.get("cc") or "").upper() == code:
-                return float(item.get("rate"))
-        raise RuntimeError(f"NBU: currency not found: {code}")
-
-    eur_uah = find("EUR")
-    usd_uah = find("USD")
+    data = orjson.loads(await _get_bytes(session, url))
+
+    rates = {(item.get("cc") or "").upper(): item.get("rate") for item in data}
+    try:
+        eur_uah = float(rates["EUR"])
+        usd_uah = float(rates["USD"])
+    except KeyError as e:
+        raise RuntimeError(f"NBU: currency not found: {e.args[0]}") from e
     return NbuRates(eur_uah=eur_uah, usd_uah=usd_uah, as_of=datetime.now(timezone.utc))
 
 
@@ -86,16 +119,10 @@ async def fetch_binance(session: aiohttp.ClientSession) -> BinanceRates:
     base = "https://api.binance.com/api/v3/ticker/price"
 
     async def price(symbol: str) -> float:
-        async with session.get(base, params={"symbol": symbol}, timeout=20) as resp:
-            resp.raise_for_status()
-            payload: dict[str, Any] = await resp.json()
-            return float(payload["price"])
-
-    # EURUSDT: USDT per 1 EUR
-    eur_usdt = await price("EURUSDT")
-    # USDTUAH: UAH per 1 USDT
-    usdt_uah = await price("USDTUAH")
-    # USDTUSD: USD per 1 USDT
-    usdt_usd = await price("USDTUSD")
+        payload: dict[str, Any] = orjson.loads(await _get_bytes(session, base, params={"symbol": symbol}))
+        return float(payload["price"])
+
+    # EURUSDT: USDT per 1 EUR; USDTUAH: UAH per 1 USDT; USDTUSD: USD per 1 USDT
+    eur_usdt, usdt_uah, usdt_usd = await asyncio.gather(price("EURUSDT"), price("USDTUAH"), price("USDTUSD"))
 
     return BinanceRates(eur_usdt=eur_usdt, usdt_uah=usdt_uah, usdt_usd=usdt_usd, as_of=datetime.now(timezone.utc))
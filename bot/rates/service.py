@@ -1,14 +1,27 @@
 from __future__ import annotations
 
+import asyncio
+import heapq
+import logging
+import time
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Tuple
 
 import aiohttp
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 
+from ..repository import load_rates, save_rates
 from .providers import BinanceRates, CbrRates, NbuRates, fetch_binance, fetch_cbr, fetch_nbu
 
 
+# Tie-break between paths with the same hop count: lower is preferred
+_SOURCE_PREFERENCE = {"CBR": 0, "NBU": 0, "CBR+NBU": 1, "Binance": 2}
+
+# While providers are down, stale rates are served this long before they are retried
+_STALE_RETRY_SECONDS = 30
+
+
 @dataclass(frozen=True)
 class RateResult:
     rate: float
@@ -17,35 +30,119 @@ class RateResult:
 
 
 class RateService:
-    def __init__(self, ttl_seconds: int = 600):
+    def __init__(self, ttl_seconds: int = 600, session_factory: async_sessionmaker[AsyncSession] | None = None):
         self.ttl = timedelta(seconds=ttl_seconds)
-        self._cache: dict[str, tuple[datetime, RateResult]] = {}
+        self._session_factory = session_factory
+        # last successfully fetched provider rates, kept as a fallback when providers are down
+        self._last_base: tuple[CbrRates, NbuRates, BinanceRates] | None = None
+        self._matrix: dict[tuple[str, str], RateResult] = {}
+        self._matrix_expires = 0.0  # time.monotonic() deadline
         self._last_sources_as_of: datetime | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self._session_lock = asyncio.Lock()
+        self._inflight: asyncio.Future | None = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        # one long-lived session so keep-alive/TLS are reused between refreshes
+        if self._session is not None and not self._session.closed:
+            return self._session
+        async with self._session_lock:
+            if self._session is None or self._session.closed:
+                self._session = aiohttp.ClientSession(
+                    headers={"User-Agent": "u2c-exchange-bot/1.0"},
+                    connector=aiohttp.TCPConnector(limit=16, ttl_dns_cache=300, keepalive_timeout=60),
+                )
+            return self._session
+
+    async def aclose(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def load_persisted(self) -> None:
+        """Warm the service from the rates_cache table (last successful refresh)."""
+        if self._session_factory is None:
+            return
+        async with self._session_factory() as db:
+            rows = await load_rates(db)
+        try:
+            base = _base_from_rows(rows)
+        except KeyError:
+            return
+        self._last_base = base
+        self._last_sources_as_of = max(r.as_of for r in base)
+        now = datetime.now(timezone.utc)
+        # rows are fresh only if every provider is within the TTL
+        remaining = (min(r.as_of for r in base) + self.ttl - now).total_seconds()
+        if remaining > 0:
+            self._matrix = self._build_matrix(self._build_graph(*base), now)
+            self._matrix_expires = time.monotonic() + remaining
 
     async def get_rate(self, frm: str, to: str) -> RateResult:
         frm = frm.upper()
         to = to.upper()
-        key = f"{frm}->{to}"
-        now = datetime.now(timezone.utc)
-        cached = self._cache.get(key)
-        if cached and cached[0] > now:
-            return cached[1]
+        if frm == to:
+            # no refresh needed for an identity conversion
+            return RateResult(rate=1.0, path=[], as_of=self._last_sources_as_of or datetime.now(timezone.utc))
+        matrix = await self._get_matrix()
+        result = matrix.get((frm, to))
+        if result is None:
+            raise RuntimeError(f"No conversion path from {frm} to {to}")
+        return result
+
+    async def _get_matrix(self) -> dict[tuple[str, str], RateResult]:
+        # all pairs are precomputed from the same snapshot and served until it expires
+        if self._matrix_expires > time.monotonic():
+            return self._matrix
+
+        # single-flight: concurrent cache misses wait for one refresh instead of starting their own;
+        # no await between the check and the assignment, so no lock is needed
+        fut = self._inflight
+        if fut is None:
+            fut = asyncio.get_running_loop().create_future()
+            self._inflight = fut
+            try:
+                fut.set_result(await self._refresh())
+            except Exception as e:
+                fut.set_exception(e)
+            finally:
+                if not fut.done():
+                    fut.cancel()
+                self._inflight = None
+        return await fut
 
-        # Refresh base rates (CBR+NBU+Binance) once per call; inexpensive for small bot
-        async with aiohttp.ClientSession(headers={"User-Agent": "u2c-exchange-bot/1.0"}) as session:
+    async def _refresh(self) -> dict[tuple[str, str], RateResult]:
+        now = datetime.now(timezone.utc)
+        try:
+            session = await self._get_session()
             cbr, nbu, bnc = await self._fetch_all(session)
+        except Exception:
+            if self._last_base is None:
+                raise
+            # cached briefly so requests during an outage don't each wait out the timeouts
+            logging.warning("Rate providers failed, serving last known rates", exc_info=True)
+            self._matrix = self._build_matrix(self._build_graph(*self._last_base), now, stale=True)
+            self._matrix_expires = time.monotonic() + _STALE_RETRY_SECONDS
+            return self._matrix
 
-        graph = self._build_graph(cbr, nbu, bnc)
-        rate, path, as_of = self._find_rate(graph, frm, to, now)
-        result = RateResult(rate=rate, path=path, as_of=as_of)
-        self._cache[key] = (now + self.ttl, result)
-        return result
+        self._last_base = (cbr, nbu, bnc)
+        self._matrix = self._build_matrix(self._build_graph(cbr, nbu, bnc), now)
+        self._matrix_expires = time.monotonic() + self.ttl.total_seconds()
+        await self._persist(cbr, nbu, bnc)
+        return self._matrix
+
+    async def _persist(self, cbr: CbrRates, nbu: NbuRates, bnc: BinanceRates) -> None:
+        if self._session_factory is None:
+            return
+        try:
+            async with self._session_factory() as db:
+                await save_rates(db, _base_to_rows(cbr, nbu, bnc))
+        except Exception:
+            logging.exception("Failed to persist rates")
 
     async def _fetch_all(self, session: aiohttp.ClientSession) -> tuple[CbrRates, NbuRates, BinanceRates]:
-        # run sequentially to keep it simple and predictable
-        cbr = await fetch_cbr(session)
-        nbu = await fetch_nbu(session)
-        bnc = await fetch_binance(session)
+        # providers are independent; total latency is the slowest one
+        cbr, nbu, bnc = await asyncio.gather(fetch_cbr(session), fetch_nbu(session), fetch_binance(session))
         # as_of: latest of sources
         self._last_sources_as_of = max(cbr.as_of, nbu.as_of, bnc.as_of)
         return cbr, nbu, bnc
@@ -93,6 +190,22 @@ class RateService:
 
         return g
 
+    def _build_matrix(
+        self,
+        graph: Dict[str, List[Tuple[str, float, str]]],
+        now: datetime,
+        stale: bool = False,
+    ) -> dict[tuple[str, str], RateResult]:
+        """All-pairs table; the graph has 5 nodes, so this is 25 small searches per refresh."""
+        matrix: dict[tuple[str, str], RateResult] = {}
+        for frm in graph:
+            for to in graph:
+                rate, path, as_of = self._find_rate(graph, frm, to, now)
+                if stale:
+                    path = [(a, b, f"{src}, stale") for a, b, src in path]
+                matrix[(frm, to)] = RateResult(rate=rate, path=path, as_of=as_of)
+        return matrix
+
     def _find_rate(
         self,
         graph: Dict[str, List[Tuple[str, float, str]]],
@@ -103,25 +216,23 @@ class RateService:
         if frm == to:
             return 1.0, [], self._last_sources_as_of or now
 
-        # BFS over small graph with path multiplication
-        from collections import deque
-
-        q = deque()
-        q.append(frm)
+        # Dijkstra over small graph: fewest hops first, then prefer official sources
+        dist: dict[str, tuple[int, int]] = {frm: (0, 0)}
         prev: dict[str, tuple[str, float, str]] = {}
-        visited = set([frm])
+        heap: list[tuple[int, int, str]] = [(0, 0, frm)]
 
-        while q:
-            cur = q.popleft()
+        while heap:
+            hops, pref, cur = heapq.heappop(heap)
+            if cur == to:
+                break
+            if (hops, pref) > dist[cur]:
+                continue
             for nxt, r, src in graph.get(cur, []):
-                if nxt in visited:
-                    continue
-                visited.add(nxt)
-                prev[nxt] = (cur, r, src)
-                if nxt == to:
-                    q.clear()
-                    break
-                q.append(nxt)
+                cand = (hops + 1, pref + _SOURCE_PREFERENCE.get(src, len(_SOURCE_PREFERENCE)))
+                if nxt not in dist or cand < dist[nxt]:
+                    dist[nxt] = cand
+                    prev[nxt] = (cur, r, src)
+                    heapq.heappush(heap, (*cand, nxt))
 
         if to not in prev:
             raise RuntimeError(f"No conversion path from {frm} to {to}")
@@ -139,3 +250,29 @@ class RateService:
 
         as_of = self._last_sources_as_of or now
         return rate, path_edges, as_of
+
+
+def _base_to_rows(cbr: CbrRates, nbu: NbuRates, bnc: BinanceRates) -> dict[str, tuple[float, datetime]]:
+    """Provider rates as rates_cache rows: key -> (value, as_of)."""
+    return {
+        "CBR:EUR_RUB": (cbr.eur_rub, cbr.as_of),
+        "CBR:USD_RUB": (cbr.usd_rub, cbr.as_of),
+        "NBU:EUR_UAH": (nbu.eur_uah, nbu.as_of),
+        "NBU:USD_UAH": (nbu.usd_uah, nbu.as_of),
+        "Binance:EURUSDT": (bnc.eur_usdt, bnc.as_of),
+        "Binance:USDTUAH": (bnc.usdt_uah, bnc.as_of),
+        "Binance:USDTUSD": (bnc.usdt_usd, bnc.as_of),
+    }
+
+
+def _base_from_rows(rows: dict[str, tuple[float, datetime]]) -> tuple[CbrRates, NbuRates, BinanceRates]:
+    """Inverse of _base_to_rows; raises KeyError if any row is missing."""
+    cbr = CbrRates(eur_rub=rows["CBR:EUR_RUB"][0], usd_rub=rows["CBR:USD_RUB"][0], as_of=rows["CBR:EUR_RUB"][1])
+    nbu = NbuRates(eur_uah=rows["NBU:EUR_UAH"][0], usd_uah=rows["NBU:USD_UAH"][0], as_of=rows["NBU:EUR_UAH"][1])
+    bnc = BinanceRates(
+        eur_usdt=rows["Binance:EURUSDT"][0],
+        usdt_uah=rows["Binance:USDTUAH"][0],
+        usdt_usd=rows["Binance:USDTUSD"][0],
+        as_of=rows["Binance:EURUSDT"][1],
+    )
+    return cbr, nbu, bnc
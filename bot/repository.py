@@ -1,40 +1,178 @@
 from __future__ import annotations
 
-import csv
-import io
-from datetime import datetime
+import asyncio
+import logging
+import re
+import tempfile
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import lru_cache
+from itertools import islice
+from typing import Any, AsyncIterator, Iterable, Sequence
 
 from aiogram.types import User as TgUser
-from sqlalchemy import select, update
-from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import Row, bindparam, event, func, insert, lambda_stmt, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+from sqlalchemy.orm import Session, SessionTransaction
 
-from .db import utcnow
 from .models import Order, RateCache, User
 
 
+# Functions used by handlers do not commit, so related writes (create_order + set_order_calc)
+# share one transaction. Handlers commit their writes before calling Telegram (the /start
+# registration, order ids sent to the admin); DbSessionMiddleware commits whatever is left.
+# Background and batch jobs (flush_last_seen, save_rates, bulk_upsert_users) commit their own work.
+
+
+def _insert(session: AsyncSession):
+    """Dialect insert() with on_conflict_do_update (Postgres in production, SQLite in development)."""
+    return sqlite_insert if session.bind.dialect.name == "sqlite" else pg_insert
+
+
+# Last written (username, first_name, last_name, language_code) per user. When it is
+# unchanged the user is only queued in _pending_seen for the next batched last_seen_at flush.
+# Anything else that writes these columns (e.g. toggling is_blocked) must call
+# forget_user() so the next upsert writes the row again.
+_user_cache: OrderedDict[int, tuple] = OrderedDict()
+_USER_CACHE_MAX = 4096
+
+# Cache entries wait in session.info until the upsert's transaction commits; a rollback
+# drops them, so a lost write is retried on the user's next update.
+_USER_CACHE_PENDING = "pending_user_cache"
+
+_pending_seen: set[int] = set()
+_SEEN_FLUSH_MAX = 500
+_seen_flush_needed = asyncio.Event()
+
+
+def forget_user(user_id: int) -> None:
+    _user_cache.pop(user_id, None)
+
+
+@event.listens_for(Session, "after_commit")
+def _apply_pending_user_cache(session: Session) -> None:
+    pending = session.info.pop(_USER_CACHE_PENDING, None)
+    if not pending:
+        return
+    for user_id, key in pending.items():
+        _user_cache[user_id] = key
+        _user_cache.move_to_end(user_id)
+    while len(_user_cache) > _USER_CACHE_MAX:
+        _user_cache.popitem(last=False)
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _drop_pending_user_cache(session: Session, transaction: SessionTransaction) -> None:
+    # after_commit has already run for committed transactions; anything left was rolled back
+    if transaction.parent is None:
+        session.info.pop(_USER_CACHE_PENDING, None)
+
+
 async def upsert_user(session: AsyncSession, tg: TgUser) -> None:
-    now = utcnow()
-    existing = await session.get(User, tg.id)
-    if existing is None:
-        session.add(User(
-            user_id=tg.id,
-            username=tg.username,
-            first_name=tg.first_name,
-            last_name=tg.last_name,
-            language_code=tg.language_code,
-            created_at=now,
-            last_seen_at=now,
-            is_blocked=False,
-        ))
-        await session.commit()
+    key = (tg.username, tg.first_name, tg.last_name, tg.language_code)
+    if _user_cache.get(tg.id) == key:
+        _pending_seen.add(tg.id)
+        if len(_pending_seen) >= _SEEN_FLUSH_MAX:
+            _seen_flush_needed.set()
         return
 
-    existing.username = tg.username
-    existing.first_name = tg.first_name
-    existing.last_name = tg.last_name
-    existing.language_code = tg.language_code
-    existing.last_seen_at = now
-    await session.commit()
+    stmt = _insert(session)(User).values(
+        user_id=tg.id,
+        username=tg.username,
+        first_name=tg.first_name,
+        last_name=tg.last_name,
+        language_code=tg.language_code,
+        is_blocked=False,
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[User.user_id],
+        set_={
+            "username": stmt.excluded.username,
+            "first_name": stmt.excluded.first_name,
+            "last_name": stmt.excluded.last_name,
+            "language_code": stmt.excluded.language_code,
+            "last_seen_at": func.now(),
+        },
+    )
+    await session.execute(stmt)
+    session.info.setdefault(_USER_CACHE_PENDING, {})[tg.id] = key
+
+
+async def bulk_upsert_users(session: AsyncSession, rows: Iterable[dict[str, Any]], chunk: int = 5000) -> int:
+    """Upsert many users (e.g. an admin import), one multi-row INSERT ... ON CONFLICT per chunk.
+
+    rows are dicts with user_id, username, first_name, last_name, language_code. The default
+    chunk keeps a statement under asyncpg's 32767 bind-parameter limit. Commits every chunk.
+    """
+    total = 0
+    it = iter(rows)
+    while batch := list(islice(it, chunk)):
+        stmt = _insert(session)(User).values([
+            {
+                "user_id": r["user_id"],
+                "username": r.get("username"),
+                "first_name": r.get("first_name"),
+                "last_name": r.get("last_name"),
+                "language_code": r.get("language_code"),
+            }
+            for r in batch
+        ])
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[User.user_id],
+            set_={
+                "username": stmt.excluded.username,
+                "first_name": stmt.excluded.first_name,
+                "last_name": stmt.excluded.last_name,
+                "language_code": stmt.excluded.language_code,
+            },
+        )
+        await session.execute(stmt)
+        await session.commit()
+        for r in batch:
+            forget_user(r["user_id"])
+        total += len(batch)
+    return total
+
+
+async def flush_last_seen(session: AsyncSession) -> int:
+    """Set last_seen_at = now() for queued users in one UPDATE; returns the number of users."""
+    if not _pending_seen:
+        return 0
+    batch = set(_pending_seen)
+    _pending_seen.clear()
+    try:
+        await session.execute(
+            update(User).where(User.user_id.in_(batch)).values(last_seen_at=func.now()),
+            execution_options={"synchronize_session": False},
+        )
+        await session.commit()
+    except BaseException:
+        # retry these users on the next flush; also on cancellation, so the final flush at shutdown sees them
+        _pending_seen.update(batch)
+        raise
+    return len(batch)
+
+
+async def run_last_seen_flusher(session_factory: async_sessionmaker[AsyncSession], interval: float = 1.5) -> None:
+    """Background loop: flush last_seen_at every `interval` seconds or once the queue is full."""
+    try:
+        while True:
+            try:
+                await asyncio.wait_for(_seen_flush_needed.wait(), timeout=interval)
+            except asyncio.TimeoutError:
+                pass
+            _seen_flush_needed.clear()
+            try:
+                async with session_factory() as db:
+                    await flush_last_seen(db)
+            except Exception:
+                logging.exception("Failed to flush last_seen_at")
+    finally:
+        # final flush on shutdown
+        async with session_factory() as db:
+            await flush_last_seen(db)
 
 
 async def create_order(
@@ -46,9 +184,9 @@ async def create_order(
     amount_value: float,
     from_location: str,
     to_location: str,
-) -> Order:
-    now = utcnow()
-    order = Order(
+) -> int:
+    """Insert a new order in the calc stage and return its id."""
+    stmt = insert(Order).values(
         user_id=user_id,
         give_currency=give_currency,
         get_currency=get_currency,
@@ -57,12 +195,22 @@ async def create_order(
         from_location=from_location,
         to_location=to_location,
         stage="calc",
-        created_at=now,
-    )
-    session.add(order)
-    await session.commit()
-    await session.refresh(order)
-    return order
+    ).returning(Order.id)
+    return (await session.execute(stmt)).scalar_one()
+
+
+# Built once; lambda_stmt caches the compiled SQL by code location, skipping per-call
+# cache-key generation. Bind names must differ from the SET column names.
+_UPDATE_ORDER_CALC = lambda_stmt(lambda: update(Order).where(Order.id == bindparam("order_id")).values(
+    rate=bindparam("new_rate"),
+    calculated_give=bindparam("new_give"),
+    calculated_get=bindparam("new_get"),
+    sources=bindparam("new_sources"),
+).returning(Order.id))
+_UPDATE_ORDER_SUBMIT = lambda_stmt(lambda: update(Order).where(Order.id == bindparam("order_id")).values(
+    contact=bindparam("new_contact"),
+    stage="submitted",
+).returning(Order.id))
 
 
 async def set_order_calc(
@@ -72,49 +220,150 @@ async def set_order_calc(
     calculated_give: float,
     calculated_get: float,
     sources: str,
-) -> None:
-    order = await session.get(Order, order_id)
-    if order is None:
-        return
-    order.rate = rate
-    order.calculated_give = calculated_give
-    order.calculated_get = calculated_get
-    order.sources = sources
-    await session.commit()
+) -> bool:
+    """Store the calculation; False if the order does not exist (no separate SELECT)."""
+    result = await session.execute(
+        _UPDATE_ORDER_CALC,
+        {
+            "order_id": order_id,
+            "new_rate": rate,
+            "new_give": calculated_give,
+            "new_get": calculated_get,
+            "new_sources": sources,
+        },
+        execution_options={"synchronize_session": False},
+    )
+    return result.first() is not None
 
 
 async def set_order_contact_and_submit(
     session: AsyncSession,
     order_id: int,
     contact: str,
-) -> None:
-    order = await session.get(Order, order_id)
-    if order is None:
+) -> bool:
+    """Mark the order submitted; False if the order does not exist (no separate SELECT)."""
+    result = await session.execute(
+        _UPDATE_ORDER_SUBMIT,
+        {"order_id": order_id, "new_contact": contact},
+        execution_options={"synchronize_session": False},
+    )
+    return result.first() is not None
+
+
+_EXPORT_BATCH_SIZE = 1000
+_EXPORT_CHUNK_SIZE = 64 * 1024
+_EXPORT_SPOOL_SIZE = 8 * 1024 * 1024
+
+_EXPORT_HEADER = b"user_id,username,first_name,last_name,language,created_at,last_seen_at,is_blocked\r\n"
+_CSV_SPECIAL = re.compile(r'[,"\r\n]')
+
+# timestamps as datetime.isoformat() gives them for UTC values, like the fallback path
+_PG_ISO_UTC = """to_char({} AT TIME ZONE 'UTC', 'YYYY-MM-DD"T"HH24:MI:SS.US"+00:00"')"""
+
+_EXPORT_USERS_COPY_SQL = (
+    # CSV mode writes NULL unquoted but '' as "", so empty values go out as NULL
+    "SELECT user_id, NULLIF(username, '') AS username, NULLIF(first_name, '') AS first_name,"
+    " NULLIF(last_name, '') AS last_name, NULLIF(language_code, '') AS language,"
+    f" {_PG_ISO_UTC.format('created_at')} AS created_at, {_PG_ISO_UTC.format('last_seen_at')} AS last_seen_at,"
+    " is_blocked::int AS is_blocked"
+    " FROM users ORDER BY users.created_at ASC"  # the table column, not the text alias
+)
+
+
+async def export_users_csv(session: AsyncSession) -> AsyncIterator[bytes]:
+    """Users as CSV, yielded in chunks so the whole table is never held in memory."""
+    conn = await session.connection()
+    if conn.dialect.name == "postgresql":
+        # server-side COPY streams CSV straight from Postgres, no ORM objects are built;
+        # spooled to disk past a few MB while Telegram consumes it
+        raw = await conn.get_raw_connection()
+        with tempfile.SpooledTemporaryFile(max_size=_EXPORT_SPOOL_SIZE) as f:
+            await raw.driver_connection.copy_from_query(_EXPORT_USERS_COPY_SQL, output=f, format="csv", header=True)
+            f.seek(0)
+            quoted = False
+            while chunk := f.read(_EXPORT_CHUNK_SIZE):
+                chunk, quoted = _crlf_records(chunk, quoted)
+                yield chunk
         return
-    order.contact = contact
-    order.stage = "submitted"
-    await session.commit()
 
+    # fixed schema: format rows directly, quoting only text fields that need it (csv.excel rules)
+    yield _EXPORT_HEADER
+    q = select(
+        User.user_id,
+        User.username,
+        User.first_name,
+        User.last_name,
+        User.language_code,
+        User.created_at,
+        User.last_seen_at,
+        User.is_blocked,
+    ).order_by(User.created_at.asc())
+    result = await session.stream(q.execution_options(yield_per=_EXPORT_BATCH_SIZE))
+    try:
+        async for rows in result.partitions():
+            # formatting is CPU-bound; keep the event loop free for other updates meanwhile
+            yield await asyncio.to_thread(_render_users_csv, rows)
+    finally:
+        _iso.cache_clear()
 
-async def export_users_csv(session: AsyncSession) -> bytes:
-    q = await session.execute(select(User).order_by(User.created_at.asc()))
-    users = q.scalars().all()
 
-    buf = io.StringIO()
-    writer = csv.writer(buf)
-    writer.writerow([
-        "user_id", "username", "first_name", "last_name", "language", "created_at", "last_seen_at", "is_blocked"
-    ])
-    for u in users:
-        writer.writerow([
-            u.user_id,
-            u.username or "",
-            u.first_name or "",
-            u.last_name or "",
-            u.language_code or "",
-            u.created_at.isoformat(),
-            u.last_seen_at.isoformat(),
-            int(u.is_blocked),
-        ])
+def _crlf_records(chunk: bytes, quoted: bool) -> tuple[bytes, bool]:
+    """End CSV records with CRLF like csv.writer; COPY writes LF. Newlines inside quoted fields are kept.
+
+    quoted carries whether the previous chunk ended inside a quoted field ("" escapes keep the parity).
+    """
+    parts = chunk.split(b"\n")
+    out = bytearray()
+    for part in parts[:-1]:
+        quoted ^= part.count(b'"') & 1
+        out += part
+        out += b"\n" if quoted else b"\r\n"
+    quoted ^= parts[-1].count(b'"') & 1
+    out += parts[-1]
+    return bytes(out), bool(quoted)
+
+
+def _render_users_csv(rows: Sequence[Row]) -> bytes:
+    lines = [
+        f"{user_id},{_csv_text(username)},{_csv_text(first_name)},{_csv_text(last_name)},"
+        f"{_csv_text(language_code)},{_iso(created_at)},{_iso(last_seen_at)},{int(is_blocked)}\r\n"
+        for user_id, username, first_name, last_name, language_code, created_at, last_seen_at, is_blocked in rows
+    ]
+    return "".join(lines).encode("utf-8")
+
+
+@lru_cache(maxsize=4096)
+def _iso(dt: datetime) -> str:
+    # users registered in bursts share timestamps; only kept for the duration of an export
+    return dt.isoformat()
+
+
+def _csv_text(value: str | None) -> str:
+    if not value:
+        return ""
+    if _CSV_SPECIAL.search(value):
+        return '"' + value.replace('"', '""') + '"'
+    return value
 
-    return buf.getvalue().encode("utf-8")
+
+async def load_rates(session: AsyncSession) -> dict[str, tuple[float, datetime]]:
+    q = await session.execute(select(RateCache))
+    # SQLite drops the offset; rates are always stored in UTC
+    return {
+        row.key: (row.value, row.as_of if row.as_of.tzinfo else row.as_of.replace(tzinfo=timezone.utc))
+        for row in q.scalars()
+    }
+
+
+async def save_rates(session: AsyncSession, rates: dict[str, tuple[float, datetime]]) -> None:
+    if not rates:
+        return
+    stmt = _insert(session)(RateCache).values([
+        {"key": key, "value": value, "as_of": as_of} for key, (value, as_of) in rates.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[RateCache.key],
+        set_={"value": stmt.excluded.value, "as_of": stmt.excluded.as_of},
+    )
+    await session.execute(stmt)
+    await session.commit()
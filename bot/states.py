@@ -1,13 +1,35 @@
+from __future__ import annotations
+
 from aiogram.fsm.state import State, StatesGroup
 
 
+class _InternedState(State):
+    """State whose "Group:name" string is built once instead of on every access.
+
+    The name is fixed when the state is bound to its group, so this is only for
+    top-level groups (a nested group learns its parent after its states are bound).
+    """
+
+    _full_state: str | None = None
+
+    def __set_name__(self, owner: type[StatesGroup], name: str) -> None:
+        super().__set_name__(owner, name)
+        self._full_state = super().state
+
+    @property
+    def state(self) -> str | None:
+        if self._full_state is not None:
+            return self._full_state
+        return super().state
+
+
 class ExchangeFlow(StatesGroup):
-    choose_give = State()
-    choose_get = State()
-    choose_amount_mode = State()
-    enter_amount = State()
-    enter_from_location = State()
-    enter_to_location = State()
-    waiting_for_calc = State()
-    enter_contact = State()
-    waiting_for_submit = State()
+    choose_give = _InternedState()
+    choose_get = _InternedState()
+    choose_amount_mode = _InternedState()
+    enter_amount = _InternedState()
+    enter_from_location = _InternedState()
+    enter_to_location = _InternedState()
+    waiting_for_calc = _InternedState()
+    enter_contact = _InternedState()
+    waiting_for_submit = _InternedState()